@@ -5,19 +5,27 @@ Sistema de procesamiento de imágenes médicas con IA
 
 import os
 import sys
-import json
+import asyncio
+import threading
 import traceback
+from collections import OrderedDict, deque
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from types import MappingProxyType
+from typing import List, Dict, Any, Optional, Tuple
 import logging
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import uvicorn
+import anyio
 import numpy as np
+import orjson
+import cv2
 from PIL import Image
 import io
 import base64
@@ -35,7 +43,6 @@ logger = logging.getLogger(__name__)
 try:
     import tensorflow as tf
     from tensorflow.keras.models import load_model
-    from tensorflow.keras.preprocessing.image import img_to_array
     TF_AVAILABLE = True
 except ImportError:
     logger.warning("TensorFlow no está disponible. Usando modo simulación.")
@@ -45,18 +52,28 @@ except ImportError:
 class Config:
     MODEL_BRAIN_PATH = Path("models/brain_model.h5")
     MODEL_CHEST_PATH = Path("models/chest_model.h5")
+    # Modelos cuantizados int8 (generados con convert_models.py), preferidos si existen
+    MODEL_BRAIN_TFLITE_PATH = Path("models/brain_model.tflite")
+    MODEL_CHEST_TFLITE_PATH = Path("models/chest_model.tflite")
     IMG_SIZE = (224, 224)
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
     SUPPORTED_FORMATS = {".jpg", ".jpeg", ".png", ".bmp", ".dcm"}
     CACHE_DIR = Path("cache")
-    HISTORY_FILE = Path("data/history.json")
+    HISTORY_FILE = Path("data/history.jsonl")
+    LEGACY_HISTORY_FILE = Path("data/history.json")
+    HISTORY_LIMIT = 1000
+    PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "1024"))
     PORT = int(os.environ.get("FLASK_PORT", "5000"))
+    # Micro-batching de inferencia (equivalente a SharedBatchScheduler de TF-Serving)
+    MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+    BATCH_TIMEOUT_MICROS = int(os.environ.get("BATCH_TIMEOUT_MICROS", "5000"))
+    # Hilos para trabajo bloqueante (decodificación, inferencia, exportación)
+    THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", max(4, os.cpu_count() or 1)))
 
 config = Config()
 
 # Crear directorios necesarios
 config.CACHE_DIR.mkdir(exist_ok=True)
-config.HISTORY_FILE.parent.mkdir(exist_ok=True, parents=True)
 
 # Inicializar FastAPI
 app = FastAPI(
@@ -163,74 +180,100 @@ MEDICAL_REPORTS = {
     }
 }
 
+# Los reportes se comparten entre peticiones, caché e historial: hacerlos inmutables
+MEDICAL_REPORTS = {cls: MappingProxyType(report) for cls, report in MEDICAL_REPORTS.items()}
+
+# Parámetros del modo simulación
+SIMULATION_RNG = np.random.default_rng()
+SIMULATION_ALPHA = {
+    'brain': np.full(len(BRAIN_CLASSES), 0.5),
+    'chest': np.full(len(CHEST_CLASSES), 0.5)
+}
+
 # Cargar modelos
 class ModelManager:
     def __init__(self):
         self.brain_model = None
         self.chest_model = None
+        # Intérpretes TFLite por tamaño de lote fijo
+        self.brain_interpreters: Optional[Dict[int, Any]] = None
+        self.chest_interpreters: Optional[Dict[int, Any]] = None
         self.models_loaded = False
-        
-        if TF_AVAILABLE:
-            self.load_models()
+        # Una cola y una tarea de despacho por tipo de modelo
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._batch_tasks: Dict[str, asyncio.Task] = {}
+        # Buffer de entrada preasignado por modelo para evitar reservas por lote
+        self._batch_buffers: Dict[str, np.ndarray] = {}
+        # Tamaños de lote de los intérpretes TFLite: las imágenes sueltas usan
+        # el de 1 y el resto de lotes se rellena hasta MAX_BATCH_SIZE. Los
+        # tensores se reservan una sola vez y no en cada lote, y la memoria
+        # queda en la de un único intérprete de lote máximo
+        self._tflite_batch_sizes = tuple(sorted({1, config.MAX_BATCH_SIZE}))
     
     def load_models(self):
         """Cargar modelos de IA"""
         try:
-            if config.MODEL_BRAIN_PATH.exists():
+            if config.MODEL_BRAIN_TFLITE_PATH.exists():
+                self.brain_interpreters = self._load_interpreters(config.MODEL_BRAIN_TFLITE_PATH)
+                logger.info("Modelo cerebral TFLite cargado exitosamente")
+            elif config.MODEL_BRAIN_PATH.exists():
                 self.brain_model = load_model(str(config.MODEL_BRAIN_PATH))
                 logger.info("Modelo cerebral cargado exitosamente")
             else:
                 logger.warning(f"Modelo cerebral no encontrado en {config.MODEL_BRAIN_PATH}")
             
-            if config.MODEL_CHEST_PATH.exists():
+            if config.MODEL_CHEST_TFLITE_PATH.exists():
+                self.chest_interpreters = self._load_interpreters(config.MODEL_CHEST_TFLITE_PATH)
+                logger.info("Modelo torácico TFLite cargado exitosamente")
+            elif config.MODEL_CHEST_PATH.exists():
                 self.chest_model = load_model(str(config.MODEL_CHEST_PATH))
                 logger.info("Modelo torácico cargado exitosamente")
             else:
                 logger.warning(f"Modelo torácico no encontrado en {config.MODEL_CHEST_PATH}")
             
-            self.models_loaded = (self.brain_model is not None or self.chest_model is not None)
+            self.models_loaded = self.has_model('brain') or self.has_model('chest')
+            self._warmup()
         except Exception as e:
             logger.error(f"Error cargando modelos: {e}")
             self.models_loaded = False
     
-    def predict(self, image: np.ndarray, model_type: str) -> Dict[str, Any]:
-        """Realizar predicción en una imagen"""
-        if not TF_AVAILABLE or not self.models_loaded:
-            # Modo simulación
-            return self._simulate_prediction(model_type)
-        
+    def _warmup(self):
+        """Ejecutar una inferencia en vacío para que ninguna petición pague la inicialización"""
+        # Los intérpretes TFLite ya se invocan al cargarlos, antes de publicarse;
+        # invocarlos aquí podría coincidir con un lote en curso durante una recarga
+        dummy = np.zeros((1, *config.IMG_SIZE, 3), dtype=np.float32)
+        for model_type, model in (('brain', self.brain_model), ('chest', self.chest_model)):
+            if model is not None:
+                model(dummy, training=False)
+                logger.info(f"Modelo {model_type} precalentado")
+    
+    def _load_interpreters(self, model_path: Path) -> Dict[int, Any]:
+        """Cargar un modelo TFLite (XNNPACK en CPU) con un intérprete por tamaño de lote"""
+        model_content = model_path.read_bytes()
+        interpreters = {}
+        for size in self._tflite_batch_sizes:
+            interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=os.cpu_count())
+            input_index = interpreter.get_input_details()[0]['index']
+            interpreter.resize_tensor_input(input_index, (size, *config.IMG_SIZE, 3))
+            interpreter.allocate_tensors()
+            # Primera invocación: prepara el delegado antes de la primera petición
+            interpreter.invoke()
+            interpreters[size] = interpreter
+        return interpreters
+    
+    def has_model(self, model_type: str) -> bool:
+        """Indicar si hay un modelo (Keras o TFLite) disponible para el tipo dado"""
+        if model_type == 'brain':
+            return self.brain_interpreters is not None or self.brain_model is not None
+        return self.chest_interpreters is not None or self.chest_model is not None
+    
+    async def predict(self, image: np.ndarray, model_type: str) -> Dict[str, Any]:
+        """Realizar predicción en una imagen (agrupada en lotes con otras peticiones)"""
         try:
-            model = self.brain_model if model_type == 'brain' else self.chest_model
-            classes = BRAIN_CLASSES if model_type == 'brain' else CHEST_CLASSES
-            
-            if model is None:
-                return self._simulate_prediction(model_type)
-            
-            # Preprocesar imagen
-            image = image.astype('float32') / 255.0
-            image = np.expand_dims(image, axis=0)
-            
-            # Predicción
-            predictions = model.predict(image, verbose=0)[0]
-            
-            # Procesar resultados
-            results = {}
-            max_idx = 0
-            max_prob = 0
-            
-            for i, cls in enumerate(classes):
-                prob = float(predictions[i]) * 100
-                results[cls] = prob
-                if prob > max_prob:
-                    max_prob = prob
-                    max_idx = i
-            
-            return {
-                'success': True,
-                'prediction': classes[max_idx],
-                'confidence': max_prob,
-                'all_predictions': results
-            }
+            # Encolar y esperar a que el lote se ejecute
+            future = asyncio.get_running_loop().create_future()
+            await self._get_queue(model_type).put((image, future))
+            return await future
             
         except Exception as e:
             logger.error(f"Error en predicción: {e}")
@@ -239,65 +282,291 @@ class ModelManager:
                 'error': str(e)
             }
     
-    def _simulate_prediction(self, model_type: str) -> Dict[str, Any]:
-        """Simulación de predicción para desarrollo"""
+    def _get_queue(self, model_type: str) -> asyncio.Queue:
+        """Obtener la cola del modelo, arrancando su tarea de despacho si hace falta"""
+        task = self._batch_tasks.get(model_type)
+        if task is None or task.done():
+            self._queues[model_type] = asyncio.Queue()
+            self._batch_tasks[model_type] = asyncio.create_task(self._batch_loop(model_type))
+        return self._queues[model_type]
+    
+    async def _batch_loop(self, model_type: str):
+        """Agrupar peticiones pendientes y ejecutar el modelo una vez por lote"""
+        queue = self._queues[model_type]
+        buffer = self._batch_buffers.get(model_type)
+        if buffer is None:
+            buffer = np.empty((config.MAX_BATCH_SIZE, *config.IMG_SIZE, 3), dtype=np.float32)
+            self._batch_buffers[model_type] = buffer
+        timeout = config.BATCH_TIMEOUT_MICROS / 1e6
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + timeout
+            
+            while len(batch) < config.MAX_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                if not self.models_loaded or not self.has_model(model_type):
+                    # Modo simulación
+                    results = self._simulate_batch(model_type, len(batch))
+                else:
+                    classes = BRAIN_CLASSES if model_type == 'brain' else CHEST_CLASSES
+                    images = np.stack([image for image, _ in batch], out=buffer[:len(batch)])
+                    predictions = await run_in_threadpool(self._run_model, model_type, images)
+                    results = self._postprocess_batch(predictions, classes)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    def _run_model(self, model_type: str, images: np.ndarray) -> np.ndarray:
+        """Ejecutar el modelo sobre un lote (B, 224, 224, 3) y devolver probabilidades"""
+        interpreters = self.brain_interpreters if model_type == 'brain' else self.chest_interpreters
+        if interpreters is not None:
+            return self._invoke_interpreter(interpreters, images)
+        
+        model = self.brain_model if model_type == 'brain' else self.chest_model
+        return np.asarray(model(images, training=False))
+    
+    def _invoke_interpreter(self, interpreters: Dict[int, Any], images: np.ndarray) -> np.ndarray:
+        """Ejecutar un intérprete TFLite aplicando la cuantización de entrada y salida"""
+        # Usar el intérprete del menor tamaño fijo que contiene el lote; las
+        # filas sobrantes conservan datos de lotes anteriores y se descartan
+        batch_size = len(images)
+        size = next(s for s in self._tflite_batch_sizes if s >= batch_size)
+        interpreter = interpreters[size]
+        input_details = interpreter.get_input_details()[0]
+        output_details = interpreter.get_output_details()[0]
+        
+        # Escribir la entrada directamente en el buffer del intérprete (sin set_tensor),
+        # cuantizando con la escala y punto cero del modelo. La vista no debe
+        # seguir viva durante invoke()
+        input_tensor = interpreter.tensor(input_details['index'])
+        scale, zero_point = input_details['quantization']
+        if scale:
+            limits = np.iinfo(input_details['dtype'])
+            input_tensor()[:batch_size] = np.clip(np.rint(images / scale + zero_point), limits.min, limits.max)
+        else:
+            input_tensor()[:batch_size] = images
+        interpreter.invoke()
+        
+        # Descuantizar la salida (la descuantización ya produce una copia propia)
+        scale, zero_point = output_details['quantization']
+        if scale:
+            output = interpreter.tensor(output_details['index'])()[:batch_size]
+            return (output.astype(np.float32) - zero_point) * scale
+        return interpreter.get_tensor(output_details['index'])[:batch_size]
+    
+    def _postprocess_batch(self, predictions: np.ndarray, classes: List[str]) -> List[Dict[str, Any]]:
+        """Convertir una matriz (B, n_clases) de probabilidades en los resultados del lote"""
+        probs = np.asarray(predictions, dtype=np.float64) * 100.0
+        
+        # Encontrar la clase con mayor probabilidad de cada imagen
+        best = probs.argmax(axis=1)
+        
+        return [
+            {
+                'success': True,
+                'prediction': classes[idx],
+                'confidence': float(row[idx]),
+                'all_predictions': dict(zip(classes, row.tolist()))
+            }
+            for idx, row in zip(best.tolist(), probs)
+        ]
+    
+    def _simulate_batch(self, model_type: str, batch_size: int) -> List[Dict[str, Any]]:
+        """Simulación de predicción para desarrollo (un lote completo de una vez)"""
         classes = BRAIN_CLASSES if model_type == 'brain' else CHEST_CLASSES
         
         # Generar probabilidades aleatorias pero realistas
-        probs = np.random.dirichlet(np.ones(len(classes)) * 0.5)
-        results = {cls: float(prob * 100) for cls, prob in zip(classes, probs)}
-        
-        # Encontrar la clase con mayor probabilidad
-        max_class = max(results, key=results.get)
+        probs = SIMULATION_RNG.dirichlet(SIMULATION_ALPHA[model_type], size=batch_size)
         
-        return {
-            'success': True,
-            'prediction': max_class,
-            'confidence': results[max_class],
-            'all_predictions': results
-        }
+        return self._postprocess_batch(probs, classes)
 
 # Instancia del gestor de modelos
 model_manager = ModelManager()
 
+class HistoryStore:
+    """Historial de análisis en JSONL de solo anexado con índice en memoria"""
+    def __init__(self, path: Path, legacy_path: Path, limit: int):
+        self.path = path
+        self.limit = limit
+        self.entries = deque(maxlen=limit)
+        self._lock = threading.Lock()
+        
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        stored_lines = self._load(legacy_path)
+        
+        # Compactar si el archivo acumula más registros de los que se conservan
+        if stored_lines > limit or not self.path.exists():
+            self._rewrite()
+        self._file = open(self.path, 'ab', buffering=0)
+    
+    def _load(self, legacy_path: Path) -> int:
+        """Cargar el historial existente y devolver el número de líneas leídas"""
+        if not self.path.exists():
+            # Migrar el historial JSON de versiones anteriores
+            if legacy_path.exists():
+                with open(legacy_path, 'rb') as f:
+                    self.entries.extend(orjson.loads(f.read()))
+            return 0
+        
+        count = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                count += 1
+                try:
+                    self.entries.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    logger.warning("Línea de historial corrupta ignorada")
+        return count
+    
+    def _rewrite(self):
+        """Reescribir el archivo completo a partir del índice en memoria"""
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.writelines(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in self.entries)
+        os.replace(tmp_path, self.path)
+    
+    def append(self, entry: Dict[str, Any]):
+        """Agregar un registro (O(1))"""
+        with self._lock:
+            self.entries.append(entry)
+            self._file.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+    
+    def page(self, offset: int, limit: int) -> List[Dict[str, Any]]:
+        """Obtener una página del historial"""
+        with self._lock:
+            return list(islice(self.entries, offset, offset + limit))
+    
+    def delete(self, analysis_id: str) -> bool:
+        """Eliminar un registro, compactando el archivo solo si existía"""
+        with self._lock:
+            remaining = [e for e in self.entries if e.get('analysis_id') != analysis_id]
+            if len(remaining) == len(self.entries):
+                return False
+            
+            self.entries = deque(remaining, maxlen=self.limit)
+            self._file.close()
+            self._rewrite()
+            self._file = open(self.path, 'ab', buffering=0)
+            return True
+    
+    def close(self):
+        """Cerrar el archivo de anexado"""
+        with self._lock:
+            self._file.close()
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+
+# Se abre en el arranque de cada proceso, no al importar el módulo
+history_store: Optional[HistoryStore] = None
+
 # Funciones auxiliares
-def decode_base64_image(base64_string: str) -> Image.Image:
-    """Decodificar imagen desde base64"""
+class PredictionCache:
+    """Caché LRU de predicciones indexada por el hash del contenido de la imagen"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+    
+    def get(self, key: Tuple[bytes, str]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+    
+    def put(self, key: Tuple[bytes, str], entry: Dict[str, Any]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+
+# Solo se accede desde el event loop, por lo que no necesita bloqueo
+prediction_cache = PredictionCache(config.PREDICTION_CACHE_SIZE)
+
+def decode_base64_data(base64_string: str) -> bytes:
+    """Decodificar los bytes de una imagen en base64"""
     try:
         # Remover el prefijo data:image/xxx;base64, si existe
         if ',' in base64_string:
             base64_string = base64_string.split(',')[1]
         
-        image_data = base64.b64decode(base64_string)
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Convertir a RGB si es necesario
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        return image
+        return base64.b64decode(base64_string)
     except Exception as e:
         raise ValueError(f"Error decodificando imagen: {e}")
 
-def preprocess_image(image: Image.Image) -> np.ndarray:
-    """Preprocesar imagen para el modelo"""
+def content_hash(image_data: bytes) -> bytes:
+    """Hash SHA-256 del contenido original de la imagen"""
+    return hashlib.sha256(image_data).digest()
+
+def load_image(image_data: bytes) -> Image.Image:
+    """Decodificar imagen desde sus bytes"""
+    try:
+        return open_image(io.BytesIO(image_data))
+    except Exception as e:
+        raise ValueError(f"Error decodificando imagen: {e}")
+
+def open_image(fp) -> Image.Image:
+    """Abrir imagen desde un archivo o flujo binario"""
+    image = Image.open(fp)
+    
+    # En JPEG, decodificar directamente a escala reducida (1/2, 1/4 u 1/8)
+    image.draft('RGB', config.IMG_SIZE)
+    
+    # Convertir a RGB si es necesario
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    return image
+
+def preprocess_image(image: Image.Image) -> Tuple[np.ndarray, float]:
+    """
+    Preprocesar imagen para el modelo
+    
+    Returns:
+        Tuple: Imagen float32 normalizada a [0, 1] e intensidad media (0-255)
+    """
+    # Reducir imágenes grandes por bloques antes del redimensionado final
+    factor = min(image.width // config.IMG_SIZE[0], image.height // config.IMG_SIZE[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    
     # Redimensionar
-    image = image.resize(config.IMG_SIZE, Image.Resampling.LANCZOS)
+    resized = cv2.resize(np.asarray(image), config.IMG_SIZE, interpolation=cv2.INTER_AREA)
     
-    # Convertir a array
-    img_array = img_to_array(image) if TF_AVAILABLE else np.array(image)
+    # Intensidad media sobre los uint8 redimensionados (reducción SIMD de OpenCV)
+    channel_means = cv2.mean(resized)
+    mean_intensity = sum(channel_means[:3]) / 3
     
-    return img_array
+    # Normalizar y convertir a float32 en una sola pasada
+    return np.multiply(resized, 1 / 255.0, dtype=np.float32), mean_intensity
 
-def determine_model_type(image: np.ndarray, requested_type: str = "auto") -> str:
+def determine_model_type(mean_intensity: float, requested_type: str = "auto") -> str:
     """Determinar el tipo de modelo a usar"""
     if requested_type != "auto":
         return requested_type
     
     # Lógica simple: usar análisis de histograma para determinar el tipo
     # En producción, esto debería ser más sofisticado
-    mean_intensity = np.mean(image)
-    
     if mean_intensity > 100:  # Imágenes más claras tienden a ser de tórax
         return "chest"
     else:
@@ -306,22 +575,29 @@ def determine_model_type(image: np.ndarray, requested_type: str = "auto") -> str
 def save_to_history(result: AnalysisResult):
     """Guardar resultado en el historial"""
     try:
-        history = []
-        if config.HISTORY_FILE.exists():
-            with open(config.HISTORY_FILE, 'r') as f:
-                history = json.load(f)
-        
-        history.append(result.dict())
-        
-        # Mantener solo los últimos 1000 registros
-        if len(history) > 1000:
-            history = history[-1000:]
-        
-        with open(config.HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
+        history_store.append(result.model_dump(mode='json'))
     except Exception as e:
         logger.error(f"Error guardando historial: {e}")
 
+@app.on_event("startup")
+async def startup():
+    """Configurar el proceso de trabajo y cargar los modelos"""
+    # Limitar los hilos de trabajo bloqueante para no saturar la CPU
+    anyio.to_thread.current_default_thread_limiter().total_tokens = config.THREADPOOL_SIZE
+    
+    global history_store
+    history_store = HistoryStore(config.HISTORY_FILE, config.LEGACY_HISTORY_FILE, config.HISTORY_LIMIT)
+    
+    # Cargar aquí y no al importar, para que el proceso supervisor no los cargue
+    if TF_AVAILABLE:
+        model_manager.load_models()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Liberar los recursos del proceso de trabajo"""
+    if history_store is not None:
+        history_store.close()
+
 # Endpoints de la API
 @app.get("/")
 async def root():
@@ -341,29 +617,68 @@ async def health_check():
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "models": {
-            "brain": model_manager.brain_model is not None,
-            "chest": model_manager.chest_model is not None
+            "brain": model_manager.has_model('brain'),
+            "chest": model_manager.has_model('chest')
         }
     }
 
-@app.post("/analyze", response_model=AnalysisResult)
+@app.post("/analyze", response_model=AnalysisResult, deprecated=True)
 async def analyze_image(
     request: AnalysisRequest,
     background_tasks: BackgroundTasks
 ):
-    """Analizar una imagen médica"""
+    """Analizar una imagen médica codificada en base64 (usar /analyze/file)"""
     try:
-        # Decodificar imagen
-        image = decode_base64_image(request.image_data)
+        image_data = await run_in_threadpool(decode_base64_data, request.image_data)
+    except Exception as e:
+        logger.error(f"Error analizando imagen: {e}")
+        return failed_result(request.image_name, e)
+    
+    return await run_analysis(image_data, request.image_name, request.analysis_type, background_tasks)
+
+@app.post("/analyze/file", response_model=AnalysisResult)
+async def analyze_file(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    analysis_type: str = Form(default="auto", pattern="^(auto|brain|chest)$")
+):
+    """Analizar una imagen médica enviada como multipart/form-data"""
+    image_data = await file.read()
+    return await run_analysis(image_data, file.filename or "sin_nombre", analysis_type, background_tasks)
+
+async def run_analysis(
+    image_data: bytes,
+    image_name: str,
+    analysis_type: str,
+    background_tasks: BackgroundTasks
+) -> AnalysisResult:
+    """Decodificar, clasificar y registrar una imagen a partir de sus bytes"""
+    try:
+        # Reutilizar la predicción si la misma imagen ya fue analizada
+        cache_key = (await run_in_threadpool(content_hash, image_data), analysis_type)
+        cached = prediction_cache.get(cache_key)
+        if cached is not None:
+            result = AnalysisResult(
+                success=True,
+                file_name=image_name,
+                timestamp=datetime.now().isoformat(),
+                analysis_id=str(uuid.uuid4()),
+                **cached
+            )
+            background_tasks.add_task(save_to_history, result)
+            return result
+        
+        # Decodificar
+        image = await run_in_threadpool(load_image, image_data)
         
         # Preprocesar
-        img_array = preprocess_image(image)
+        img_array, mean_intensity = await run_in_threadpool(preprocess_image, image)
         
         # Determinar tipo de modelo
-        model_type = determine_model_type(img_array, request.analysis_type)
+        model_type = determine_model_type(mean_intensity, analysis_type)
         
         # Realizar predicción
-        prediction_result = model_manager.predict(img_array, model_type)
+        prediction_result = await model_manager.predict(img_array, model_type)
         
         if not prediction_result['success']:
             raise HTTPException(status_code=500, detail=prediction_result.get('error', 'Error en predicción'))
@@ -377,7 +692,7 @@ async def analyze_image(
         # Crear resultado
         result = AnalysisResult(
             success=True,
-            file_name=request.image_name,
+            file_name=image_name,
             model_type=model_type,
             prediction=prediction_result['prediction'],
             confidence=prediction_result['confidence'],
@@ -387,6 +702,14 @@ async def analyze_image(
             analysis_id=str(uuid.uuid4())
         )
         
+        prediction_cache.put(cache_key, {
+            'model_type': model_type,
+            'prediction': prediction_result['prediction'],
+            'confidence': prediction_result['confidence'],
+            'all_predictions': prediction_result['all_predictions'],
+            'medical_info': medical_info
+        })
+        
         # Guardar en historial en segundo plano
         background_tasks.add_task(save_to_history, result)
         
@@ -394,13 +717,17 @@ async def analyze_image(
         
     except Exception as e:
         logger.error(f"Error analizando imagen: {e}")
-        return AnalysisResult(
-            success=False,
-            file_name=request.image_name,
-            timestamp=datetime.now().isoformat(),
-            analysis_id=str(uuid.uuid4()),
-            error=str(e)
-        )
+        return failed_result(image_name, e)
+
+def failed_result(image_name: str, error: Exception) -> AnalysisResult:
+    """Construir un resultado de análisis fallido"""
+    return AnalysisResult(
+        success=False,
+        file_name=image_name,
+        timestamp=datetime.now().isoformat(),
+        analysis_id=str(uuid.uuid4()),
+        error=str(error)
+    )
 
 @app.post("/analyze/batch")
 async def analyze_batch(
@@ -408,32 +735,21 @@ async def analyze_batch(
     background_tasks: BackgroundTasks
 ):
     """Analizar múltiples imágenes"""
-    results = []
-    
-    for img_request in request.images:
-        result = await analyze_image(img_request, background_tasks)
-        results.append(result)
+    # Lanzar todas las peticiones a la vez para que se agrupen en el mismo lote
+    results = await asyncio.gather(
+        *(analyze_image(img_request, background_tasks) for img_request in request.images)
+    )
     
     return {"results": results, "total": len(results)}
 
 @app.get("/history")
 async def get_history(
-    limit: int = 100,
-    offset: int = 0
+    limit: int = Query(default=100, ge=0),
+    offset: int = Query(default=0, ge=0)
 ):
     """Obtener historial de análisis"""
     try:
-        if not config.HISTORY_FILE.exists():
-            return {"history": [], "total": 0}
-        
-        with open(config.HISTORY_FILE, 'r') as f:
-            history = json.load(f)
-        
-        # Aplicar paginación
-        total = len(history)
-        history = history[offset:offset + limit]
-        
-        return {"history": history, "total": total}
+        return {"history": history_store.page(offset, limit), "total": len(history_store)}
     except Exception as e:
         logger.error(f"Error obteniendo historial: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -442,18 +758,7 @@ async def get_history(
 async def delete_history_item(analysis_id: str):
     """Eliminar un elemento del historial"""
     try:
-        if not config.HISTORY_FILE.exists():
-            raise HTTPException(status_code=404, detail="Historial no encontrado")
-        
-        with open(config.HISTORY_FILE, 'r') as f:
-            history = json.load(f)
-        
-        # Filtrar el elemento a eliminar
-        history = [h for h in history if h.get('analysis_id') != analysis_id]
-        
-        with open(config.HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
-        
+        await run_in_threadpool(history_store.delete, analysis_id)
         return {"message": "Elemento eliminado exitosamente"}
     except Exception as e:
         logger.error(f"Error eliminando del historial: {e}")
@@ -465,17 +770,24 @@ async def export_results(request: ExportRequest):
     try:
         if request.format == "pdf":
             # Generar PDF
-            from .pdf_generator import generate_pdf_report
-            file_path = generate_pdf_report(request.results, request.include_images)
-        else:
-            # Generar CSV
-            from .csv_generator import generate_csv_report
-            file_path = generate_csv_report(request.results)
+            from pdf_generator import generate_pdf_report
+            file_path = await run_in_threadpool(generate_pdf_report, request.results, request.include_images)
+            
+            return FileResponse(
+                file_path,
+                media_type='application/octet-stream',
+                filename=file_path.name
+            )
         
-        return FileResponse(
-            file_path,
-            media_type='application/octet-stream',
-            filename=file_path.name
+        # Generar CSV en streaming, sin archivo intermedio. Las filas se
+        # construyen antes de responder para que un error llegue como 500
+        from csv_generator import iter_csv_report
+        chunks = await run_in_threadpool(iter_csv_report, request.results)
+        file_name = f"neuro_ai_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        return StreamingResponse(
+            chunks,
+            media_type='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="{file_name}"'}
         )
     except Exception as e:
         logger.error(f"Error exportando resultados: {e}")
@@ -486,16 +798,18 @@ async def get_models_info():
     """Obtener información sobre los modelos disponibles"""
     return {
         "brain": {
-            "available": model_manager.brain_model is not None,
+            "available": model_manager.has_model('brain'),
+            "quantized": model_manager.brain_interpreters is not None,
             "classes": BRAIN_CLASSES,
             "path": str(config.MODEL_BRAIN_PATH),
-            "exists": config.MODEL_BRAIN_PATH.exists()
+            "exists": config.MODEL_BRAIN_PATH.exists() or config.MODEL_BRAIN_TFLITE_PATH.exists()
         },
         "chest": {
-            "available": model_manager.chest_model is not None,
+            "available": model_manager.has_model('chest'),
+            "quantized": model_manager.chest_interpreters is not None,
             "classes": CHEST_CLASSES,
             "path": str(config.MODEL_CHEST_PATH),
-            "exists": config.MODEL_CHEST_PATH.exists()
+            "exists": config.MODEL_CHEST_PATH.exists() or config.MODEL_CHEST_TFLITE_PATH.exists()
         }
     }
 
@@ -503,7 +817,9 @@ async def get_models_info():
 async def reload_models():
     """Recargar modelos de IA"""
     try:
-        model_manager.load_models()
+        # Carga y precalentamiento fuera del bucle de eventos
+        await run_in_threadpool(model_manager.load_models)
+        prediction_cache.clear()
         return {"success": True, "message": "Modelos recargados exitosamente"}
     except Exception as e:
         logger.error(f"Error recargando modelos: {e}")
@@ -523,9 +839,12 @@ if __name__ == "__main__":
     port = config.PORT
     logger.info(f"Iniciando Neuro-AI API en puerto {port}")
     uvicorn.run(
-        app,
+        "app:app",
         host="0.0.0.0",
         port=port,
+        workers=1,  # El historial vive en la memoria del proceso
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
         log_level="info",
         reload=False
     )
@@ -0,0 +1,94 @@
+"""
+Conversión de modelos Keras (.h5) a TFLite con cuantización int8 para Neuro-AI
+
+Uso:
+    python convert_models.py --brain-calibration datos/cerebro --chest-calibration datos/torax
+
+Cada directorio de calibración debe contener imágenes representativas del
+dominio (se usan hasta --samples imágenes) para estimar los rangos de
+activación. Los modelos resultantes se guardan junto a los .h5 y el backend
+los utiliza automáticamente si existen.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+import tensorflow as tf
+
+from app import open_image, preprocess_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+
+MODELS = {
+    "brain": (Path("models/brain_model.h5"), Path("models/brain_model.tflite")),
+    "chest": (Path("models/chest_model.h5"), Path("models/chest_model.tflite")),
+}
+
+def load_calibration_images(calibration_dir: Path, samples: int) -> List[np.ndarray]:
+    """Cargar y preprocesar imágenes de calibración con las funciones del backend"""
+    paths = sorted(
+        p for p in calibration_dir.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS
+    )[:samples]
+    if not paths:
+        raise ValueError(f"No se encontraron imágenes de calibración en {calibration_dir}")
+
+    images = []
+    for path in paths:
+        image, _ = preprocess_image(open_image(path))
+        images.append(image)
+    return images
+
+def convert_model(model_path: Path, output_path: Path, calibration: List[np.ndarray]) -> Path:
+    """
+    Convertir un modelo Keras a TFLite con cuantización entera completa
+
+    Args:
+        model_path: Ruta del modelo .h5
+        output_path: Ruta del modelo .tflite de salida
+        calibration: Imágenes preprocesadas para el dataset representativo
+
+    Returns:
+        Path: Ruta del modelo generado
+    """
+    model = tf.keras.models.load_model(str(model_path))
+
+    def representative_dataset() -> Iterator[List[np.ndarray]]:
+        for image in calibration:
+            yield [image[np.newaxis, ...]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+
+    output_path.write_bytes(converter.convert())
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Convertir modelos Neuro-AI a TFLite int8")
+    parser.add_argument("--brain-calibration", type=Path, help="Imágenes de calibración cerebrales")
+    parser.add_argument("--chest-calibration", type=Path, help="Imágenes de calibración torácicas")
+    parser.add_argument("--samples", type=int, default=200, help="Máximo de imágenes por modelo")
+    args = parser.parse_args()
+
+    calibration_dirs = {"brain": args.brain_calibration, "chest": args.chest_calibration}
+
+    for model_type, (model_path, output_path) in MODELS.items():
+        calibration_dir = calibration_dirs[model_type]
+        if calibration_dir is None:
+            print(f"Omitiendo modelo {model_type}: sin directorio de calibración")
+            continue
+        if not model_path.exists():
+            print(f"Omitiendo modelo {model_type}: no existe {model_path}")
+            continue
+
+        calibration = load_calibration_images(calibration_dir, args.samples)
+        convert_model(model_path, output_path, calibration)
+        print(f"Modelo {model_type} convertido: {output_path}")
+
+if __name__ == "__main__":
+    main()
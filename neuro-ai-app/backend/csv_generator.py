@@ -3,13 +3,135 @@ Generador de reportes CSV para Neuro-AI
 """
 
 import csv
+import io
+from collections import Counter
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
+
+# Columnas del reporte
+FIELDNAMES = [
+    'ID_Análisis',
+    'Fecha_Hora',
+    'Archivo',
+    'Tipo_Análisis',
+    'Éxito',
+    'Diagnóstico',
+    'Confianza_%',
+    'Nivel_Prioridad',
+    'Urgencia',
+    'Título_Diagnóstico',
+    'Descripción_Clínica',
+    'Recomendaciones',
+    'Probabilidad_Glioma_%',
+    'Probabilidad_Meningioma_%',
+    'Probabilidad_Normal_%',
+    'Probabilidad_Pituitaria_%',
+    'Probabilidad_Neumonía_%',
+    'Probabilidad_COVID19_%',
+    'Probabilidad_Tuberculosis_%',
+    'Probabilidad_Opacidad_Pulmonar_%',
+    'Error'
+]
+
+# Posición de cada columna en la fila
+COL_INDEX = {name: i for i, name in enumerate(FIELDNAMES)}
+
+# Mapeo de nombres de clases a posiciones de columna
+CLASS_COLUMNS = [
+    (cls, COL_INDEX[column]) for cls, column in (
+        ('glioma', 'Probabilidad_Glioma_%'),
+        ('meningioma', 'Probabilidad_Meningioma_%'),
+        ('normal', 'Probabilidad_Normal_%'),
+        ('pituitary', 'Probabilidad_Pituitaria_%'),
+        ('pneumonia', 'Probabilidad_Neumonía_%'),
+        ('covid19', 'Probabilidad_COVID19_%'),
+        ('tuberculosis', 'Probabilidad_Tuberculosis_%'),
+        ('lung_opacity', 'Probabilidad_Opacidad_Pulmonar_%')
+    )
+]
+
+# Columnas de información médica y su clave en medical_info
+MEDICAL_COLUMNS = [
+    (COL_INDEX['Nivel_Prioridad'], 'nivel'),
+    (COL_INDEX['Urgencia'], 'urgencia'),
+    (COL_INDEX['Título_Diagnóstico'], 'titulo'),
+    (COL_INDEX['Descripción_Clínica'], 'descripcion'),
+    (COL_INDEX['Recomendaciones'], 'recomendaciones')
+]
+
+# Filas por bloque al generar el CSV de forma incremental
+CSV_CHUNK_ROWS = 500
+
+def build_row(result: Dict[str, Any]) -> List[str]:
+    """Construir la fila posicional del CSV para un resultado"""
+    row = [''] * len(FIELDNAMES)
+    success = result.get('success', False)
+    analysis_id = result.get('analysis_id')
+    model_type = result.get('model_type')
+    prediction = result.get('prediction')
+    confidence = result.get('confidence')
+    
+    row[COL_INDEX['ID_Análisis']] = analysis_id[:8] if analysis_id else ''
+    row[COL_INDEX['Fecha_Hora']] = result.get('timestamp', '')
+    row[COL_INDEX['Archivo']] = result.get('file_name', '')
+    row[COL_INDEX['Tipo_Análisis']] = model_type.upper() if model_type else ''
+    row[COL_INDEX['Éxito']] = 'Sí' if success else 'No'
+    row[COL_INDEX['Diagnóstico']] = prediction.upper() if prediction else ''
+    row[COL_INDEX['Confianza_%']] = f"{confidence:.2f}" if confidence else '0'
+    row[COL_INDEX['Error']] = result.get('error', '') if not success else ''
+    
+    # Agregar información médica si está disponible
+    medical_info = result.get('medical_info')
+    if medical_info:
+        for index, key in MEDICAL_COLUMNS:
+            row[index] = medical_info.get(key, '')
+    
+    # Agregar probabilidades individuales
+    predictions = result.get('all_predictions')
+    if predictions:
+        for cls, index in CLASS_COLUMNS:
+            if cls in predictions:
+                row[index] = f"{predictions[cls]:.2f}"
+    
+    return row
+
+def iter_csv_report(results: List[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    Generar el reporte CSV por bloques, listo para enviarse en streaming
+    
+    Las filas se construyen antes de devolver el iterador: un resultado
+    inválido lanza la excepción aquí y no a mitad de la respuesta
+    
+    Args:
+        results: Lista de resultados de análisis
+    
+    Returns:
+        Iterator[bytes]: Fragmentos UTF-8 del CSV (con BOM para Excel)
+    """
+    return _iter_csv_chunks([build_row(result) for result in results])
+
+def _iter_csv_chunks(rows: List[List[str]]) -> Iterator[bytes]:
+    """Serializar las filas del CSV por bloques"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    # Encabezados
+    buffer.write('\ufeff')
+    writer.writerow(FIELDNAMES)
+    yield buffer.getvalue().encode('utf-8')
+    
+    # Datos
+    for start in range(0, len(rows), CSV_CHUNK_ROWS):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows[start:start + CSV_CHUNK_ROWS])
+        yield buffer.getvalue().encode('utf-8')
 
 def generate_csv_report(
     results: List[Dict[str, Any]],
-    output_dir: Path = Path("exports")
+    output_dir: Path = Path("exports"),
+    timestamp: Optional[str] = None
 ) -> Path:
     """
     Generar un reporte CSV con los resultados del análisis
@@ -17,6 +139,7 @@ def generate_csv_report(
     Args:
         results: Lista de resultados de análisis
         output_dir: Directorio de salida
+        timestamp: Sufijo de los nombres de archivo (por defecto, fecha y hora actual)
     
     Returns:
         Path: Ruta del archivo CSV generado
@@ -25,86 +148,13 @@ def generate_csv_report(
     output_dir.mkdir(exist_ok=True)
     
     # Nombre del archivo
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_path = output_dir / f"neuro_ai_report_{timestamp}.csv"
     
-    # Definir las columnas
-    fieldnames = [
-        'ID_Análisis',
-        'Fecha_Hora',
-        'Archivo',
-        'Tipo_Análisis',
-        'Éxito',
-        'Diagnóstico',
-        'Confianza_%',
-        'Nivel_Prioridad',
-        'Urgencia',
-        'Título_Diagnóstico',
-        'Descripción_Clínica',
-        'Recomendaciones',
-        'Probabilidad_Glioma_%',
-        'Probabilidad_Meningioma_%',
-        'Probabilidad_Normal_%',
-        'Probabilidad_Pituitaria_%',
-        'Probabilidad_Neumonía_%',
-        'Probabilidad_COVID19_%',
-        'Probabilidad_Tuberculosis_%',
-        'Probabilidad_Opacidad_Pulmonar_%',
-        'Error'
-    ]
-    
     # Escribir el archivo CSV
-    with open(file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        
-        # Escribir encabezados
-        writer.writeheader()
-        
-        # Escribir datos
-        for result in results:
-            row = {
-                'ID_Análisis': result.get('analysis_id', '')[:8] if result.get('analysis_id') else '',
-                'Fecha_Hora': result.get('timestamp', ''),
-                'Archivo': result.get('file_name', ''),
-                'Tipo_Análisis': result.get('model_type', '').upper() if result.get('model_type') else '',
-                'Éxito': 'Sí' if result.get('success', False) else 'No',
-                'Diagnóstico': result.get('prediction', '').upper() if result.get('prediction') else '',
-                'Confianza_%': f"{result.get('confidence', 0):.2f}" if result.get('confidence') else '0',
-                'Error': result.get('error', '') if not result.get('success', False) else ''
-            }
-            
-            # Agregar información médica si está disponible
-            if result.get('medical_info'):
-                medical_info = result['medical_info']
-                row.update({
-                    'Nivel_Prioridad': medical_info.get('nivel', ''),
-                    'Urgencia': medical_info.get('urgencia', ''),
-                    'Título_Diagnóstico': medical_info.get('titulo', ''),
-                    'Descripción_Clínica': medical_info.get('descripcion', ''),
-                    'Recomendaciones': medical_info.get('recomendaciones', '')
-                })
-            
-            # Agregar probabilidades individuales
-            if result.get('all_predictions'):
-                predictions = result['all_predictions']
-                
-                # Mapeo de nombres de clases a columnas
-                class_mapping = {
-                    'glioma': 'Probabilidad_Glioma_%',
-                    'meningioma': 'Probabilidad_Meningioma_%',
-                    'normal': 'Probabilidad_Normal_%',
-                    'pituitary': 'Probabilidad_Pituitaria_%',
-                    'pneumonia': 'Probabilidad_Neumonía_%',
-                    'covid19': 'Probabilidad_COVID19_%',
-                    'tuberculosis': 'Probabilidad_Tuberculosis_%',
-                    'lung_opacity': 'Probabilidad_Opacidad_Pulmonar_%'
-                }
-                
-                for cls, column in class_mapping.items():
-                    if cls in predictions:
-                        row[column] = f"{predictions[cls]:.2f}"
-            
-            writer.writerow(row)
+    with open(file_path, 'wb') as csvfile:
+        csvfile.writelines(iter_csv_report(results))
     
     # Crear archivo de resumen estadístico
     summary_path = output_dir / f"neuro_ai_summary_{timestamp}.csv"
@@ -120,29 +170,42 @@ def generate_summary_csv(results: List[Dict[str, Any]], file_path: Path):
         results: Lista de resultados
         file_path: Ruta del archivo de resumen
     """
-    # Calcular estadísticas
+    # Calcular estadísticas en una sola pasada
     total = len(results)
-    successful = sum(1 for r in results if r.get('success', False))
-    failed = total - successful
-    
-    # Contar por tipo de análisis
-    brain_count = sum(1 for r in results if r.get('model_type') == 'brain')
-    chest_count = sum(1 for r in results if r.get('model_type') == 'chest')
+    successful = brain_count = chest_count = 0
+    high_priority = medium_priority = low_priority = 0
+    diagnosis_counts = Counter()
+    confidences = []
     
-    # Contar por nivel de prioridad
-    high_priority = sum(1 for r in results 
-                       if r.get('medical_info', {}).get('nivel') == 'ALTO')
-    medium_priority = sum(1 for r in results 
-                         if r.get('medical_info', {}).get('nivel') == 'MEDIO')
-    low_priority = sum(1 for r in results 
-                      if r.get('medical_info', {}).get('nivel') == 'BAJO')
+    for r in results:
+        if r.get('success', False):
+            successful += 1
+        
+        # Contar por tipo de análisis
+        model_type = r.get('model_type')
+        if model_type == 'brain':
+            brain_count += 1
+        elif model_type == 'chest':
+            chest_count += 1
+        
+        # Contar por nivel de prioridad
+        level = (r.get('medical_info') or {}).get('nivel')
+        if level == 'ALTO':
+            high_priority += 1
+        elif level == 'MEDIO':
+            medium_priority += 1
+        elif level == 'BAJO':
+            low_priority += 1
+        
+        # Contar diagnósticos
+        if r.get('prediction'):
+            diagnosis_counts[r['prediction']] += 1
+        
+        confidence = r.get('confidence')
+        if confidence:
+            confidences.append(confidence)
     
-    # Contar diagnósticos
-    diagnosis_counts = {}
-    for result in results:
-        if result.get('prediction'):
-            pred = result['prediction']
-            diagnosis_counts[pred] = diagnosis_counts.get(pred, 0) + 1
+    failed = total - successful
     
     # Escribir resumen
     with open(file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
@@ -181,14 +244,13 @@ def generate_summary_csv(results: List[Dict[str, Any]], file_path: Path):
         writer.writerow(['DISTRIBUCIÓN DE DIAGNÓSTICOS'])
         writer.writerow(['Diagnóstico', 'Cantidad', 'Porcentaje'])
         
-        for diagnosis, count in sorted(diagnosis_counts.items(), key=lambda x: x[1], reverse=True):
+        for diagnosis, count in diagnosis_counts.most_common():
             percentage = (count/total*100) if total > 0 else 0
             writer.writerow([diagnosis.upper(), count, f"{percentage:.1f}%"])
         
         writer.writerow([])
         
         # Confianza promedio
-        confidences = [r.get('confidence', 0) for r in results if r.get('confidence')]
         if confidences:
             avg_confidence = sum(confidences) / len(confidences)
             min_confidence = min(confidences)
@@ -215,13 +277,11 @@ def export_batch_csv(
         List[Path]: Lista de rutas de archivos generados
     """
     generated_files = []
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     for i, batch in enumerate(results_batches, 1):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_path = output_dir / f"neuro_ai_batch_{i}_{timestamp}.csv"
-        
-        # Usar la función principal para cada lote
-        generate_csv_report(batch, output_dir)
+        # Usar la función principal para cada lote, con un nombre único por lote
+        file_path = generate_csv_report(batch, output_dir, timestamp=f"{timestamp}_{i}")
         generated_files.append(file_path)
     
     return generated_files
@@ -2,11 +2,26 @@
 Generador de reportes PDF para Neuro-AI
 """
 
+import os
+from bisect import bisect_right
+from operator import itemgetter
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from functools import lru_cache
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set
+from xml.sax.saxutils import escape as _xesc
 import io
 import base64
+import tempfile
+import uuid
+
+from reportlab import rl_config
+
+# Flujos comprimidos en binario, sin la capa ASCII85 (que agrega un 25%)
+rl_config.useA85 = 0
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, A4
@@ -20,135 +35,373 @@ from reportlab.platypus import (
 )
 from reportlab.platypus.tableofcontents import TableOfContents
 from reportlab.pdfgen import canvas
-from PIL import Image as PILImage
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+# Estilos (construidos una sola vez al importar el módulo)
+_STYLES = getSampleStyleSheet()
+
+TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_STYLES['Title'],
+    fontSize=24,
+    textColor=colors.HexColor('#1e293b'),
+    spaceAfter=30,
+    alignment=TA_CENTER
+)
+
+H1_STYLE = ParagraphStyle(
+    'CustomHeading1',
+    parent=_STYLES['Heading1'],
+    fontSize=18,
+    textColor=colors.HexColor('#2563eb'),
+    spaceBefore=20,
+    spaceAfter=12,
+    keepWithNext=True
+)
+
+H2_STYLE = ParagraphStyle(
+    'CustomHeading2',
+    parent=_STYLES['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#475569'),
+    spaceBefore=12,
+    spaceAfter=8
+)
+
+BODY_STYLE = ParagraphStyle(
+    'CustomBody',
+    parent=_STYLES['BodyText'],
+    fontSize=11,
+    textColor=colors.HexColor('#334155'),
+    alignment=TA_JUSTIFY,
+    spaceAfter=8
+)
+
+WARNING_STYLE = ParagraphStyle(
+    'Warning',
+    parent=_STYLES['Normal'],
+    fontSize=10,
+    textColor=colors.HexColor('#dc2626'),
+    backColor=colors.HexColor('#fef2f2'),
+    borderColor=colors.HexColor('#dc2626'),
+    borderWidth=1,
+    borderPadding=10,
+    alignment=TA_CENTER
+)
+
+SUMMARY_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2563eb')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#f8fafc')),
+    ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e5e7eb')),
+    ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
+])
+
+BASIC_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#64748b')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
+])
+
+# Base común; el fondo de la primera celda depende del nivel de prioridad
+# de cada estudio y lo agrega _diagnosis_style
+_DIAG_BASE = TableStyle([
+    ('TEXTCOLOR', (0, 0), (0, 0), colors.white),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (1, 0), 12),
+    ('SPAN', (1, 0), (1, 0)),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    ('TOPPADDING', (0, 0), (-1, -1), 8)
+])
+
+PROB_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#475569')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
+])
+
+NOTES_TABLE_STYLE = TableStyle([
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#fafafa'))
+])
+
+SIGNATURE_TABLE_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 11),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+    ('ALIGN', (0, 0), (0, -1), 'RIGHT'),
+    ('VALIGN', (0, 0), (-1, -1), 'BOTTOM')
+])
+
+# Filas del resumen ejecutivo: etiqueta y clave de calculate_statistics
+_SUMMARY_ROWS = (
+    ('Total de análisis', 'count_total'),
+    ('Análisis exitosos', 'successful'),
+    ('Análisis con errores', 'failed'),
+    ('Tipo predominante', 'predominant_type'),
+    ('Hallazgos críticos', 'critical'),
+    ('Hallazgos normales', 'normal')
+)
+
+# Datos fijos de las tablas de notas y firma. Table normaliza los datos en
+# listas nuevas, así que compartirlos entre documentos es seguro
+_NOTES_ROWS = [['', ''] for _ in range(5)]  # 5 filas vacías para notas
+_NOTES_TABLE_KWARGS = dict(colWidths=[6*inch], rowHeights=[0.4*inch]*5)
+
+_SIGNATURE_DATA = [
+    ['Nombre del Médico:', '_' * 40],
+    ['Especialidad:', '_' * 40],
+    ['Número de Colegiado:', '_' * 40],
+    ['Fecha de Revisión:', '_' * 40],
+    ['Firma:', ''],
+    ['', ''],
+    ['', ''],
+    ['', '_' * 40]
+]
+
+# Párrafos fijos, analizados una sola vez. Los flowables guardan estado de
+# maquetación, así que cada uso agrega una copia superficial (_clone)
+LABEL_DESCRIPTION = Paragraph("<b>Descripción Clínica:</b>", BODY_STYLE)
+LABEL_RECOMMENDATIONS = Paragraph("<b>Recomendaciones:</b>", BODY_STYLE)
+LABEL_PROBABILITIES = Paragraph("<b>Análisis Detallado de Probabilidades:</b>", BODY_STYLE)
+LABEL_NOTES = Paragraph("<b>ESPACIO PARA OBSERVACIONES MÉDICAS:</b>", BODY_STYLE)
+
+WARNING_PARAGRAPH = Paragraph("""
+    Este reporte ha sido generado por un sistema de inteligencia artificial y tiene 
+    carácter exclusivamente orientativo. NO constituye un diagnóstico médico definitivo.
+    
+    Los resultados DEBEN ser revisados y validados por un profesional médico calificado 
+    antes de tomar cualquier decisión clínica. Este documento es EDITABLE para permitir 
+    correcciones y anotaciones médicas.
+    
+    La precisión del sistema puede variar y no garantiza la detección de todas las 
+    condiciones médicas. Siempre consulte con un especialista para un diagnóstico definitivo.
+    """, WARNING_STYLE)
+
+SIGNATURE_PARAGRAPH = Paragraph("""
+    Este documento requiere validación y firma de un profesional médico calificado 
+    para su uso en decisiones clínicas.
+    """, BODY_STYLE)
+
+_clone = copy
+
+_EMPTY_DICT: Dict[str, Any] = {}
+
+# Colores por nivel de prioridad
+_PRIORITY_COLORS = {
+    'ALTO': colors.HexColor('#dc2626'),    # Rojo
+    'MEDIO': colors.HexColor('#f59e0b'),   # Naranja
+    'BAJO': colors.HexColor('#10b981')     # Verde
+}
+_DEFAULT_PRIORITY_COLOR = colors.HexColor('#64748b')  # Gris por defecto
+
+# Umbrales (límite inferior inclusivo) y etiquetas de interpretación de probabilidades
+_PROB_THRESHOLDS = (20, 40, 60, 80)
+_PROB_LABELS = (
+    "Muy baja probabilidad",
+    "Baja probabilidad",
+    "Probabilidad moderada",
+    "Alta probabilidad",
+    "Muy alta probabilidad"
+)
+
+# Logo de la portada (se comprueba una vez al importar)
+_LOGO_PATH = Path("public/icons/logo.png")
+_LOGO_EXISTS = _LOGO_PATH.exists()
+
+# Máscara de permisos del proceso (os.umask solo se puede leer cambiándola)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Directorios de salida ya creados en este proceso: evita un mkdir por reporte
+_ENSURED_DIRS: Set[Path] = set()
+
+def _make_logo_flowable() -> Image:
+    """Crear el flowable del logo (uno nuevo por reporte: no son reutilizables)"""
+    logo = Image(str(_LOGO_PATH), width=2*inch, height=2*inch)
+    logo.hAlign = 'CENTER'
+    return logo
+
+# Pie de página con la numeración
+_FOOTER_FONT = "Helvetica"
+_FOOTER_FONT_SIZE = 9
+_FOOTER_TEXT_COLOR = colors.grey
+_FOOTER_RULE_COLOR = colors.HexColor('#e5e7eb')
+_FOOTER_LEFT = inch * 0.5
+_FOOTER_RIGHT = letter[0] - inch * 0.5
+_FOOTER_TEXT_Y = inch * 0.5
+_FOOTER_RULE_Y = inch * 0.6
+
+# Comentario PDF que ocupa el lugar del número de página hasta conocer el total
+_PAGE_NUMBER_MARK = "%pageNumber"
 
 class NumberedCanvas(canvas.Canvas):
     """Canvas personalizado con números de página"""
     def __init__(self, *args, **kwargs):
         canvas.Canvas.__init__(self, *args, **kwargs)
-        self._saved_page_states = []
         self.page_num = 0
+        self._numbered_pages = []
 
     def showPage(self):
-        self._saved_page_states.append(dict(self.__dict__))
-        self._startPage()
+        # El total de páginas aún no se conoce: la página se emite ya, con la
+        # línea decorativa y un marcador que save() sustituye por el número.
+        # Así no se retiene el estado del canvas de cada página
         self.page_num += 1
+        self.draw_page_rule()
+        self.addLiteral(_PAGE_NUMBER_MARK)
+        canvas.Canvas.showPage(self)
+        # El contenido de la página se guarda como texto hasta save(). Depende
+        # de internos de ReportLab (PDFDocument.Pages y PDFPage.stream), por
+        # eso la versión está fijada en requirements.txt
+        self._numbered_pages.append(self._doc.Pages.pages[-1])
 
     def save(self):
         """Agregar números de página a cada página"""
-        num_pages = len(self._saved_page_states)
-        for state in self._saved_page_states:
-            self.__dict__.update(state)
-            self.draw_page_number(num_pages)
-            canvas.Canvas.showPage(self)
+        num_pages = self.page_num
+        for page_num, page in enumerate(self._numbered_pages, 1):
+            self.page_num = page_num
+            # El marcador es lo último que se dibuja en la página: sustituir
+            # solo esa aparición, no la que pueda traer el texto del usuario
+            head, _, tail = page.stream.rpartition(_PAGE_NUMBER_MARK)
+            page.stream = head + self.page_number_code(num_pages) + tail
         canvas.Canvas.save(self)
 
-    def draw_page_number(self, page_count):
-        """Dibujar número de página"""
-        self.setFont("Helvetica", 9)
-        self.setFillColor(colors.grey)
-        self.drawRightString(
-            letter[0] - inch * 0.5,
-            inch * 0.5,
-            f"Página {self.page_num} de {page_count}"
+    def page_number_code(self, page_count) -> str:
+        """Operadores PDF del número de página"""
+        label = f"Página {self.page_num} de {page_count}"
+        # Fuente, color y texto en un único objeto de texto (BT ... ET)
+        text = self.beginText(
+            _FOOTER_RIGHT - stringWidth(label, _FOOTER_FONT, _FOOTER_FONT_SIZE),
+            _FOOTER_TEXT_Y
         )
-        # Línea decorativa
-        self.setStrokeColor(colors.HexColor('#e5e7eb'))
-        self.line(inch * 0.5, inch * 0.6, letter[0] - inch * 0.5, inch * 0.6)
+        text.setFont(_FOOTER_FONT, _FOOTER_FONT_SIZE)
+        text.setFillColor(_FOOTER_TEXT_COLOR)
+        text.textOut(label)
+        return text.getCode()
+
+    def draw_page_rule(self):
+        """Dibujar la línea decorativa del pie de página"""
+        self.setStrokeColor(_FOOTER_RULE_COLOR)
+        self.line(_FOOTER_LEFT, _FOOTER_RULE_Y, _FOOTER_RIGHT, _FOOTER_RULE_Y)
 
 def generate_pdf_report(
     results: List[Dict[str, Any]],
     include_images: bool = True,
-    output_dir: Path = Path("exports")
+    output_dir: Path = Path("exports"),
+    timestamp: Optional[str] = None
 ) -> Path:
     """
     Generar un reporte PDF profesional con los resultados del análisis
     """
     # Crear directorio de salida si no existe
-    output_dir.mkdir(exist_ok=True)
+    _ensure_dir(output_dir)
+    
+    # Nombre del archivo (una sola marca de tiempo para todo el reporte). La
+    # marca tiene resolución de segundos: el sufijo aleatorio evita que dos
+    # exportaciones simultáneas escriban, y entreguen, el mismo archivo
+    now = datetime.now()
+    if timestamp is None:
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
+    file_path = output_dir / f"neuro_ai_report_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
+    
+    pdf_bytes = _render_report(results, now)
+    
+    try:
+        _write_atomic(file_path, pdf_bytes)
+    except FileNotFoundError:
+        # El directorio se eliminó después de crearlo: recrearlo y reintentar
+        _ENSURED_DIRS.discard(output_dir)
+        _ensure_dir(output_dir)
+        _write_atomic(file_path, pdf_bytes)
     
-    # Nombre del archivo
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    file_path = output_dir / f"neuro_ai_report_{timestamp}.pdf"
+    return file_path
+
+def _write_atomic(file_path: Path, data: bytes) -> None:
+    """
+    Escribir un archivo de forma atómica: un único write en un temporal
+    propio del mismo directorio y rename sobre la ruta final
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp crea el archivo con permisos 0600; usar los habituales
+        os.chmod(tmp_name, 0o666 & ~_UMASK)
+        os.replace(tmp_name, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+def _ensure_dir(path: Path) -> None:
+    """Crear un directorio la primera vez que se usa en el proceso"""
+    if path not in _ENSURED_DIRS:
+        path.mkdir(parents=True, exist_ok=True)
+        _ENSURED_DIRS.add(path)
+
+def _render_report(results: List[Dict[str, Any]], now: datetime) -> bytes:
+    """Renderizar el reporte completo en un único documento"""
+    story = _front_matter_flowables(results, now)
+    story.append(PageBreak())
+    
+    # Resultados detallados
+    story.append(Paragraph("RESULTADOS DETALLADOS", H1_STYLE))
+    
+    for idx, result in enumerate(results, 1):
+        story.extend(_study_flowables(idx, result))
+        
+        # Salto de página entre estudios
+        if idx < len(results):
+            story.append(PageBreak())
     
-    # Crear documento
+    story.append(PageBreak())
+    story.extend(_signature_flowables())
+    
+    # Generar PDF en memoria con canvas personalizado
+    buffer = io.BytesIO()
     doc = SimpleDocTemplate(
-        str(file_path),
+        buffer,
         pagesize=letter,
+        pageCompression=1,
         rightMargin=0.75*inch,
         leftMargin=0.75*inch,
         topMargin=1*inch,
         bottomMargin=1*inch
     )
-    
-    # Estilos
-    styles = getSampleStyleSheet()
-    
-    # Estilos personalizados
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Title'],
-        fontSize=24,
-        textColor=colors.HexColor('#1e293b'),
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-    
-    heading1_style = ParagraphStyle(
-        'CustomHeading1',
-        parent=styles['Heading1'],
-        fontSize=18,
-        textColor=colors.HexColor('#2563eb'),
-        spaceBefore=20,
-        spaceAfter=12,
-        keepWithNext=True
-    )
-    
-    heading2_style = ParagraphStyle(
-        'CustomHeading2',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor('#475569'),
-        spaceBefore=12,
-        spaceAfter=8
-    )
-    
-    body_style = ParagraphStyle(
-        'CustomBody',
-        parent=styles['BodyText'],
-        fontSize=11,
-        textColor=colors.HexColor('#334155'),
-        alignment=TA_JUSTIFY,
-        spaceAfter=8
-    )
-    
-    warning_style = ParagraphStyle(
-        'Warning',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#dc2626'),
-        backColor=colors.HexColor('#fef2f2'),
-        borderColor=colors.HexColor('#dc2626'),
-        borderWidth=1,
-        borderPadding=10,
-        alignment=TA_CENTER
-    )
-    
-    # Construir el contenido
+    doc.build(story, canvasmaker=NumberedCanvas)
+    return buffer.getvalue()
+
+def _front_matter_flowables(results: List[Dict[str, Any]], now: datetime) -> List[Any]:
+    """Portada, advertencia legal y resumen ejecutivo"""
     story = []
     
     # Portada
     story.append(Spacer(1, 1.5*inch))
-    story.append(Paragraph("NEURO-AI", title_style))
-    story.append(Paragraph("Sistema de Diagnóstico Asistido por Inteligencia Artificial", heading2_style))
+    story.append(Paragraph("NEURO-AI", TITLE_STYLE))
+    story.append(Paragraph("Sistema de Diagnóstico Asistido por Inteligencia Artificial", H2_STYLE))
     story.append(Spacer(1, 0.5*inch))
     
     # Logo o imagen decorativa (si existe)
-    logo_path = Path("public/icons/logo.png")
-    if logo_path.exists():
-        logo = Image(str(logo_path), width=2*inch, height=2*inch)
-        logo.hAlign = 'CENTER'
-        story.append(logo)
+    if _LOGO_EXISTS:
+        story.append(_make_logo_flowable())
         story.append(Spacer(1, 0.5*inch))
     
     # Información del reporte
@@ -156,293 +409,237 @@ def generate_pdf_report(
     <para align="center">
     <b>REPORTE DE ANÁLISIS DE IMÁGENES MÉDICAS</b><br/>
     <br/>
-    Fecha de generación: {datetime.now().strftime('%d de %B de %Y')}<br/>
-    Hora: {datetime.now().strftime('%H:%M:%S')}<br/>
+    Fecha de generación: {now.strftime('%d de %B de %Y')}<br/>
+    Hora: {now.strftime('%H:%M:%S')}<br/>
     Total de estudios analizados: {len(results)}<br/>
     </para>
     """
-    story.append(Paragraph(report_info, body_style))
+    story.append(Paragraph(report_info, BODY_STYLE))
     
     story.append(PageBreak())
     
     # Advertencia legal
-    story.append(Paragraph("ADVERTENCIA IMPORTANTE", heading1_style))
-    warning_text = """
-    Este reporte ha sido generado por un sistema de inteligencia artificial y tiene 
-    carácter exclusivamente orientativo. NO constituye un diagnóstico médico definitivo.
-    
-    Los resultados DEBEN ser revisados y validados por un profesional médico calificado 
-    antes de tomar cualquier decisión clínica. Este documento es EDITABLE para permitir 
-    correcciones y anotaciones médicas.
-    
-    La precisión del sistema puede variar y no garantiza la detección de todas las 
-    condiciones médicas. Siempre consulte con un especialista para un diagnóstico definitivo.
-    """
-    story.append(Paragraph(warning_text, warning_style))
+    story.append(Paragraph("ADVERTENCIA IMPORTANTE", H1_STYLE))
+    story.append(_clone(WARNING_PARAGRAPH))
     story.append(Spacer(1, 0.3*inch))
     
     # Resumen ejecutivo
-    story.append(Paragraph("RESUMEN EJECUTIVO", heading1_style))
+    story.append(Paragraph("RESUMEN EJECUTIVO", H1_STYLE))
     
     # Estadísticas generales
     stats_data = calculate_statistics(results)
     
-    summary_table_data = [
-        ['Métrica', 'Valor'],
-        ['Total de análisis', str(len(results))],
-        ['Análisis exitosos', str(stats_data['successful'])],
-        ['Análisis con errores', str(stats_data['failed'])],
-        ['Tipo predominante', stats_data['predominant_type']],
-        ['Hallazgos críticos', str(stats_data['critical'])],
-        ['Hallazgos normales', str(stats_data['normal'])]
-    ]
+    summary_table_data = [['Métrica', 'Valor']]
+    summary_table_data.extend([label, str(stats_data[key])] for label, key in _SUMMARY_ROWS)
     
     summary_table = Table(summary_table_data, colWidths=[3*inch, 3*inch])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2563eb')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#f8fafc')),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e5e7eb')),
-        ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
-    ]))
+    summary_table.setStyle(SUMMARY_TABLE_STYLE)
     
     story.append(summary_table)
-    story.append(PageBreak())
     
-    # Resultados detallados
-    story.append(Paragraph("RESULTADOS DETALLADOS", heading1_style))
-    
-    for idx, result in enumerate(results, 1):
-        # Encabezado del estudio
-        story.append(Paragraph(f"ESTUDIO #{idx}", heading2_style))
+    return story
+
+def _study_flowables(idx: int, result: Dict[str, Any]) -> List[Any]:
+    """Contenido de un estudio del reporte"""
+    study = []
+    
+    # Encabezado del estudio
+    study.append(Paragraph(f"ESTUDIO #{idx}", H2_STYLE))
+    
+    if result.get('success', False):
+        # Información básica
+        basic_info = [
+            ['Campo', 'Valor'],
+            ['Archivo', result.get('file_name', 'Sin nombre')],
+            ['Fecha de análisis', result.get('timestamp', 'No disponible')],
+            ['Tipo de análisis', result.get('model_type', 'No especificado').upper()],
+            ['ID de análisis', result.get('analysis_id', 'No disponible')[:8] + '...']
+        ]
         
-        if result.get('success', False):
-            # Información básica
-            basic_info = [
-                ['Campo', 'Valor'],
-                ['Archivo', result.get('file_name', 'Sin nombre')],
-                ['Fecha de análisis', result.get('timestamp', 'No disponible')],
-                ['Tipo de análisis', result.get('model_type', 'No especificado').upper()],
-                ['ID de análisis', result.get('analysis_id', 'No disponible')[:8] + '...']
-            ]
-            
-            basic_table = Table(basic_info, colWidths=[2*inch, 4*inch])
-            basic_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#64748b')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
-            ]))
-            
-            story.append(basic_table)
-            story.append(Spacer(1, 0.2*inch))
-            
-            # Diagnóstico principal
-            medical_info = result.get('medical_info', {})
-            diagnosis_data = [
-                ['DIAGNÓSTICO PRINCIPAL', medical_info.get('titulo', 'No disponible')],
-                ['Confianza del modelo', f"{result.get('confidence', 0):.1f}%"],
-                ['Nivel de prioridad', medical_info.get('nivel', 'No especificado')],
-                ['Urgencia', medical_info.get('urgencia', 'No especificada')]
-            ]
-            
-            # Aplicar color según el nivel
-            bg_color = get_priority_color(medical_info.get('nivel', 'BAJO'))
-            
-            diagnosis_table = Table(diagnosis_data, colWidths=[2*inch, 4*inch])
-            diagnosis_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (0, 0), bg_color),
-                ('TEXTCOLOR', (0, 0), (0, 0), colors.white),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (1, 0), 12),
-                ('SPAN', (1, 0), (1, 0)),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-                ('TOPPADDING', (0, 0), (-1, -1), 8)
-            ]))
-            
-            story.append(diagnosis_table)
-            story.append(Spacer(1, 0.2*inch))
-            
-            # Descripción clínica
-            story.append(Paragraph("<b>Descripción Clínica:</b>", body_style))
-            story.append(Paragraph(
-                medical_info.get('descripcion', 'No disponible'),
-                body_style
-            ))
-            story.append(Spacer(1, 0.1*inch))
-            
-            # Recomendaciones
-            story.append(Paragraph("<b>Recomendaciones:</b>", body_style))
-            story.append(Paragraph(
-                medical_info.get('recomendaciones', 'No disponible'),
-                body_style
-            ))
-            story.append(Spacer(1, 0.2*inch))
-            
-            # Distribución de probabilidades
-            story.append(Paragraph("<b>Análisis Detallado de Probabilidades:</b>", body_style))
-            
-            all_predictions = result.get('all_predictions', {})
-            if all_predictions:
-                prob_data = [['Clasificación', 'Probabilidad', 'Interpretación']]
-                
-                for cls, prob in sorted(all_predictions.items(), key=lambda x: x[1], reverse=True):
-                    interpretation = get_probability_interpretation(prob)
-                    prob_data.append([
-                        cls.upper(),
-                        f"{prob:.2f}%",
-                        interpretation
-                    ])
-                
-                prob_table = Table(prob_data, colWidths=[2*inch, 1.5*inch, 2.5*inch])
-                prob_table.setStyle(TableStyle([
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#475569')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTSIZE', (0, 0), (-1, -1), 10),
-                    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8fafc')])
-                ]))
-                
-                story.append(prob_table)
+        basic_table = Table(basic_info, colWidths=[2*inch, 4*inch])
+        basic_table.setStyle(BASIC_TABLE_STYLE)
+        
+        study.append(basic_table)
+        study.append(Spacer(1, 0.2*inch))
+        
+        # Diagnóstico principal
+        medical_info = result.get('medical_info', {})
+        diagnosis_data = [
+            ['DIAGNÓSTICO PRINCIPAL', medical_info.get('titulo', 'No disponible')],
+            ['Confianza del modelo', f"{result.get('confidence', 0):.1f}%"],
+            ['Nivel de prioridad', medical_info.get('nivel', 'No especificado')],
+            ['Urgencia', medical_info.get('urgencia', 'No especificada')]
+        ]
+        
+        # Aplicar color según el nivel
+        bg_color = get_priority_color(medical_info.get('nivel', 'BAJO'))
+        
+        diagnosis_table = Table(diagnosis_data, colWidths=[2*inch, 4*inch])
+        diagnosis_table.setStyle(_diagnosis_style(bg_color))
+        
+        study.append(diagnosis_table)
+        study.append(Spacer(1, 0.2*inch))
+        
+        # Descripción clínica
+        study.append(_clone(LABEL_DESCRIPTION))
+        study.append(Paragraph(
+            _xesc(medical_info.get('descripcion', 'No disponible')),
+            BODY_STYLE
+        ))
+        study.append(Spacer(1, 0.1*inch))
+        
+        # Recomendaciones
+        study.append(_clone(LABEL_RECOMMENDATIONS))
+        study.append(Paragraph(
+            _xesc(medical_info.get('recomendaciones', 'No disponible')),
+            BODY_STYLE
+        ))
+        study.append(Spacer(1, 0.2*inch))
+        
+        # Distribución de probabilidades
+        study.append(_clone(LABEL_PROBABILITIES))
+        
+        all_predictions = result.get('all_predictions', {})
+        if all_predictions:
+            prob_data = [['Clasificación', 'Probabilidad', 'Interpretación']]
             
-            # Espacio para notas médicas
-            story.append(Spacer(1, 0.3*inch))
-            story.append(Paragraph("<b>ESPACIO PARA OBSERVACIONES MÉDICAS:</b>", body_style))
+            for cls, prob in sorted(all_predictions.items(), key=itemgetter(1), reverse=True):
+                interpretation = get_probability_interpretation(prob)
+                prob_data.append([
+                    cls.upper(),
+                    f"{prob:.2f}%",
+                    interpretation
+                ])
             
-            notes_data = [['', '']] * 5  # 5 filas vacías para notas
-            notes_table = Table(notes_data, colWidths=[6*inch], rowHeights=[0.4*inch]*5)
-            notes_table.setStyle(TableStyle([
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#fafafa'))
-            ]))
-            story.append(notes_table)
+            prob_table = Table(prob_data, colWidths=[2*inch, 1.5*inch, 2.5*inch])
+            prob_table.setStyle(PROB_TABLE_STYLE)
             
-        else:
-            # Mostrar error
-            error_msg = f"""
-            <para>
-            <font color="red"><b>ERROR EN EL ANÁLISIS</b></font><br/>
-            Archivo: {result.get('file_name', 'Sin nombre')}<br/>
-            Error: {result.get('error', 'Error desconocido')}<br/>
-            </para>
-            """
-            story.append(Paragraph(error_msg, body_style))
+            study.append(prob_table)
         
-        # Salto de página entre estudios
-        if idx < len(results):
-            story.append(PageBreak())
-    
-    # Página de firma
-    story.append(PageBreak())
-    story.append(Paragraph("VALIDACIÓN MÉDICA", heading1_style))
+        # Espacio para notas médicas
+        study.append(Spacer(1, 0.3*inch))
+        study.append(_clone(LABEL_NOTES))
+        
+        notes_table = Table(_NOTES_ROWS, **_NOTES_TABLE_KWARGS)
+        notes_table.setStyle(NOTES_TABLE_STYLE)
+        study.append(notes_table)
+        
+    else:
+        # Mostrar error (los valores del resultado se escapan: el
+        # párrafo es marcado XML de ReportLab)
+        error_msg = f"""
+        <para>
+        <font color="red"><b>ERROR EN EL ANÁLISIS</b></font><br/>
+        Archivo: {_xesc(result.get('file_name', 'Sin nombre'))}<br/>
+        Error: {_xesc(str(result.get('error', 'Error desconocido')))}<br/>
+        </para>
+        """
+        study.append(Paragraph(error_msg, BODY_STYLE))
+    
+    return study
+
+def _signature_flowables() -> List[Any]:
+    """Página de validación médica con los campos para firma"""
+    story = []
+    story.append(Paragraph("VALIDACIÓN MÉDICA", H1_STYLE))
     story.append(Spacer(1, 0.5*inch))
     
-    signature_text = """
-    Este documento requiere validación y firma de un profesional médico calificado 
-    para su uso en decisiones clínicas.
-    """
-    story.append(Paragraph(signature_text, body_style))
+    story.append(_clone(SIGNATURE_PARAGRAPH))
     story.append(Spacer(1, 1*inch))
     
     # Campos para firma
-    signature_data = [
-        ['Nombre del Médico:', '_' * 40],
-        ['Especialidad:', '_' * 40],
-        ['Número de Colegiado:', '_' * 40],
-        ['Fecha de Revisión:', '_' * 40],
-        ['Firma:', ''],
-        ['', ''],
-        ['', ''],
-        ['', '_' * 40]
-    ]
-    
-    signature_table = Table(signature_data, colWidths=[2*inch, 4*inch])
-    signature_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('ALIGN', (0, 0), (0, -1), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'BOTTOM')
-    ]))
+    signature_table = Table(_SIGNATURE_DATA, colWidths=[2*inch, 4*inch])
+    signature_table.setStyle(SIGNATURE_TABLE_STYLE)
     
     story.append(signature_table)
     
-    # Generar PDF con canvas personalizado
-    doc.build(story, canvasmaker=NumberedCanvas)
-    
-    return file_path
+    return story
 
 def calculate_statistics(results: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Calcular estadísticas de los resultados"""
-    stats = {
-        'successful': 0,
-        'failed': 0,
-        'critical': 0,
-        'normal': 0,
-        'predominant_type': 'No determinado',
-        'model_types': {}
-    }
+    successful = critical = normal = 0
+    model_types = Counter()
     
     for result in results:
-        if result.get('success', False):
-            stats['successful'] += 1
+        _get = result.get
+        if _get('success', False):
+            successful += 1
             
             # Contar por tipo de modelo
-            model_type = result.get('model_type', 'unknown')
-            stats['model_types'][model_type] = stats['model_types'].get(model_type, 0) + 1
+            model_types[_get('model_type', 'unknown')] += 1
             
             # Contar niveles críticos
-            level = result.get('medical_info', {}).get('nivel', 'BAJO')
+            level = (_get('medical_info') or _EMPTY_DICT).get('nivel', 'BAJO')
             if level == 'ALTO':
-                stats['critical'] += 1
-            elif result.get('prediction') == 'normal':
-                stats['normal'] += 1
-        else:
-            stats['failed'] += 1
-    
-    # Determinar tipo predominante
-    if stats['model_types']:
-        stats['predominant_type'] = max(stats['model_types'], key=stats['model_types'].get).upper()
-    
-    return stats
+                critical += 1
+            elif _get('prediction') == 'normal':
+                normal += 1
+    
+    return {
+        'count_total': len(results),
+        'successful': successful,
+        'failed': len(results) - successful,
+        'critical': critical,
+        'normal': normal,
+        # Determinar tipo predominante
+        'predominant_type': (
+            model_types.most_common(1)[0][0].upper() if model_types else 'No determinado'
+        ),
+        'model_types': model_types
+    }
 
 def get_priority_color(level: str) -> colors.Color:
     """Obtener color según el nivel de prioridad"""
-    colors_map = {
-        'ALTO': colors.HexColor('#dc2626'),    # Rojo
-        'MEDIO': colors.HexColor('#f59e0b'),   # Naranja
-        'BAJO': colors.HexColor('#10b981')     # Verde
-    }
-    return colors_map.get(level, colors.HexColor('#64748b'))  # Gris por defecto
+    return _PRIORITY_COLORS.get(level, _DEFAULT_PRIORITY_COLOR)
+
+@lru_cache(maxsize=None)
+def _diagnosis_style(bg_color: colors.Color) -> TableStyle:
+    """Estilo de la tabla de diagnóstico, compartido por color de prioridad"""
+    style = TableStyle(parent=_DIAG_BASE)
+    style.add('BACKGROUND', (0, 0), (0, 0), bg_color)
+    return style
 
 def get_probability_interpretation(probability: float) -> str:
     """Interpretar el valor de probabilidad"""
-    if probability >= 80:
-        return "Muy alta probabilidad"
-    elif probability >= 60:
-        return "Alta probabilidad"
-    elif probability >= 40:
-        return "Probabilidad moderada"
-    elif probability >= 20:
-        return "Baja probabilidad"
-    else:
-        return "Muy baja probabilidad"
+    return _PROB_LABELS[bisect_right(_PROB_THRESHOLDS, probability)]
 
-if __name__ == "__main__":
-    # Prueba del generador
+def generate_pdf_reports_batch(
+    batch: List[List[Dict[str, Any]]],
+    include_images: bool = True,
+    output_dir: Path = Path("exports"),
+    max_workers: Optional[int] = None
+) -> List[Path]:
+    """
+    Generar varios reportes PDF en paralelo, uno por lote de resultados
+    
+    Args:
+        batch: Lista de lotes de resultados
+        include_images: Incluir imágenes en los reportes
+        output_dir: Directorio de salida
+        max_workers: Procesos a usar (por defecto, uno por núcleo)
+    
+    Returns:
+        List[Path]: Rutas de los PDFs generados, en el orden de los lotes
+    """
+    if not batch:
+        return []
+    
+    _ensure_dir(output_dir)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # El renderizado es CPU puro y sin estado compartido entre documentos:
+    # cada proceso genera un reporte completo con un nombre único por lote
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                generate_pdf_report, results, include_images, output_dir, f"{timestamp}_{i}"
+            )
+            for i, results in enumerate(batch, 1)
+        ]
+        return [future.result() for future in futures]
+
+def _demo() -> Path:
+    """Generar un reporte de prueba (solo al ejecutar el módulo directamente)"""
     test_results = [
         {
             'success': True,
@@ -468,5 +665,8 @@ if __name__ == "__main__":
         }
     ]
     
-    pdf_path = generate_pdf_report(test_results)
-    print(f"PDF generado: {pdf_path}")
+    return generate_pdf_report(test_results)
+
+if __name__ == "__main__":
+    # Prueba del generador
+    print(f"PDF generado: {_demo()}")